@@ -1,10 +1,12 @@
+import io
 import shlex
 import subprocess
 import select
+import tempfile
 from subprocess import Popen
 from time import time, sleep
 
-from typing import Union, List, Tuple
+from typing import Union, List, Optional, Tuple, Generator
 
 from rich.logging import RichHandler
 from rich.pretty import pretty_repr as pf
@@ -55,31 +57,53 @@ def timedfunc(func):
     return wrapped
 
 
-def shell_cmd(cmd: Union[str, List[str]]) -> Tuple[List[str], List[str], int]:
+def shell_cmd(cmd: Union[str, List[str]],
+              timeout: Optional[float] = 15) -> Tuple[List[str], List[str], int]:
     """Executes a shell command.
-    Returns a tuple (stdout, stderr, returncode) as a list of lines.
+    Returns a tuple (stdout, stderr, returncode) as a list of lines, or
+    (None, None, None) if the command could not be run or timed out.
     """
 
     if isinstance(cmd, str):
         cmd = shlex.split(cmd)
 
     try:
-        proc = Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        proc = subprocess.run(cmd, capture_output=True, text=True,
+                              timeout=timeout)
     except FileNotFoundError:
         logger.error(f"Error running command {cmd[0]}. It may not be installed.")
-        return None, None
-
-    try:
-        s_out, s_err = proc.communicate(timeout=15)
+        return None, None, None
     except subprocess.TimeoutExpired:
-        proc.kill()
-        s_out, s_err = proc.communicate()
+        logger.error(f"Command {cmd[0]} timed out.")
+        return None, None, None
+
+    return proc.stdout.splitlines(), proc.stderr.splitlines(), proc.returncode
+
+
+def shell_cmd_stream(cmd: Union[str, List[str]]
+                     ) -> Generator[str, None, Tuple[List[str], int]]:
+    """Executes a shell command, yielding lines of stdout as they are produced.
+    Once the command exits, the generator returns a tuple (stderr, returncode)
+    with stderr as a list of lines (use `yield from` to retrieve it).
+    """
+
+    if isinstance(cmd, str):
+        cmd = shlex.split(cmd)
+
+    # Spool stderr to a file so the command can't block on a full stderr pipe
+    # while stdout is being consumed.
+    with tempfile.TemporaryFile() as errfile:
+        try:
+            proc = Popen(cmd, stdout=subprocess.PIPE, stderr=errfile)
+        except FileNotFoundError:
+            logger.error(f"Error running command {cmd[0]}. It may not be installed.")
+            return None, None
 
-    # Convert from bytes to str.
-    s_out = s_out.decode()
-    s_err = s_err.decode()
+        with proc:
+            for line in io.TextIOWrapper(proc.stdout, encoding='utf-8'):
+                yield line.rstrip('\n')
 
-    stdout = [line for line in s_out.split('\n')]
-    stderr = [line for line in s_err.split('\n')]
+        errfile.seek(0)
+        stderr = errfile.read().decode().splitlines()
 
-    return stdout, stderr, proc.returncode
+    return stderr, proc.returncode
@@ -0,0 +1,132 @@
+import os
+import shutil
+import hashlib
+import tempfile
+from time import time
+from concurrent.futures import ThreadPoolExecutor
+
+from typing import Iterable, Iterator, List, Optional, Tuple
+from pathlib import Path
+
+import logging
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Location of cached cflow results
+# (an empty XDG_CACHE_HOME is treated as unset, per the XDG spec).
+cache_dir = Path(os.environ.get('XDG_CACHE_HOME') or '~/.cache').expanduser() / 'cflowgraph'
+
+# Entries unused for longer than this (in seconds) are removed.
+cache_ttl = 7 * 24 * 60 * 60
+
+# Maximum number of entries kept; least recently used entries are removed.
+cache_max_entries = 32
+
+
+def cache_key(cmd: List[str], paths: List[str]) -> str:
+    """Computes the cache key for running cmd over paths.
+    The key covers the full command line, the working directory (paths may be
+    relative), the cflow executable and the modification time and size of
+    every source file. File contents are not read.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for item in [os.getcwd(), *cmd]:
+        h.update(item.encode())
+        h.update(b'\0')
+
+    # os.stat releases the GIL, so stat'ing from a pool of threads overlaps
+    # the filesystem round trips (significant on network mounts).
+    stat_paths = [shutil.which(cmd[0]), *paths]
+    with ThreadPoolExecutor(max_workers=min(32, len(stat_paths))) as ex:
+        stats = list(ex.map(_stat, stat_paths))
+
+    for st in stats:
+        h.update(st)
+
+    return h.hexdigest()
+
+
+def _stat(path: str) -> bytes:
+    try:
+        st = os.stat(path)
+    except (OSError, TypeError):
+        return b'-\0'
+    return f"{st.st_mtime_ns}:{st.st_size}\0".encode()
+
+
+def _read_lines(path: Path) -> Iterator[str]:
+    with open(path, encoding='utf-8') as fp:
+        for line in fp:
+            yield line.rstrip('\n')
+
+
+def load(key: str) -> Optional[Tuple[Iterator[str], List[str]]]:
+    """Looks up a cache entry. Returns a tuple (stdout, stderr) in the same
+    form as a cflow run, or None if there is no valid entry.
+    """
+    out_path = cache_dir / f"{key}.out"
+    err_path = cache_dir / f"{key}.err"
+    try:
+        if time() - out_path.stat().st_mtime > cache_ttl:
+            return None
+        stderr = err_path.read_text(encoding='utf-8').splitlines()
+        # Mark the entry as recently used.
+        os.utime(out_path)
+    except OSError:
+        return None
+
+    logger.debug(f"Cache hit: {out_path}")
+    return _read_lines(out_path), stderr
+
+
+def store(key: str, lines: Iterable[str], stderr: List[str]) -> Iterator[str]:
+    """Yields lines, writing them to the cache under key as they pass.
+    The entry (including stderr, which must be filled in by the time lines is
+    exhausted) is only committed once all lines have been consumed.
+    """
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    except OSError as e:
+        logger.debug(f"Caching disabled: {str(e)}")
+        yield from lines
+        return
+
+    try:
+        with open(fd, 'w', encoding='utf-8') as fp:
+            for line in lines:
+                fp.write(line)
+                fp.write('\n')
+                yield line
+
+        (cache_dir / f"{key}.err").write_text('\n'.join(stderr), encoding='utf-8')
+        os.replace(tmp_name, cache_dir / f"{key}.out")
+        logger.debug(f"Cached cflow output as {key}")
+    finally:
+        if os.path.exists(tmp_name):
+            os.unlink(tmp_name)
+
+    evict()
+
+
+def evict() -> None:
+    """Removes expired entries and the least recently used entries beyond
+    cache_max_entries.
+    """
+    entries = []
+    for out_path in cache_dir.glob('*.out'):
+        try:
+            entries.append((out_path.stat().st_mtime, out_path))
+        except OSError:
+            pass
+
+    entries.sort(reverse=True)
+    now = time()
+    for k, (mtime, out_path) in enumerate(entries):
+        if k >= cache_max_entries or now - mtime > cache_ttl:
+            logger.debug(f"Evicting cache entry {out_path.stem}")
+            for path in (out_path, out_path.with_suffix('.err')):
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
@@ -1,14 +1,22 @@
+import os
 import os.path as osp
+import re
 import sys
+import heapq
+import shutil
 import click
 
-from typing import Iterable, List
+from time import time
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, List, Optional, Pattern, Tuple
 from pathlib import Path
 
 from rich.console import Console
 from rich import inspect
 
-from . import setuplogging, timedfunc, shell_cmd, pf
+from . import setuplogging, timedfunc, shell_cmd, shell_cmd_stream, pf
+from . import cache
 from .parser import CflowParser
 
 # Use the root logger for the application level.
@@ -19,14 +27,31 @@ paths_always_exclude = (
     'site-packages',
 )
 
+# Suffixes of the files passed to cflow.
+source_suffixes = ('.c', '.h')
+
 console = Console()
 
+# Whether cflow was found on the PATH (None until first checked).
+cflow_installed = None
+
+
+def compile_excludes(excludes: List[str]) -> Optional[Pattern]:
+    """Compiles a list of excluded paths into a single regex matching any of
+    them, or None if the list is empty.
+    """
+    if not excludes:
+        return None
+    return re.compile('|'.join(re.escape(ex) for ex in excludes))
+
 
 @timedfunc
 def get_file_list(root: str,
                   excluded_paths: Iterable[str] = None,
-                  no_builtin_excludes: bool = False) -> List[Path]:
+                  no_builtin_excludes: bool = False) -> List[str]:
     """Searches for .c and .h files starting at root.
+    Paths are handled as plain strings throughout; no Path objects are created
+    for the files found.
     """
     # Combine passed user excluded paths with always excluded.
     if no_builtin_excludes:
@@ -34,42 +59,161 @@ def get_file_list(root: str,
     else:
         excludes = excluded_paths + paths_always_exclude
 
-    root = Path(root).expanduser()
+    root = osp.normpath(osp.expanduser(root))
     logger.debug(f"Getting files from {root}")
 
     paths = []
-    status_msg = "[magenta]Searching paths for files:[/magenta]"
-    i = 0
-    with console.status(status_msg) as status:
-        for p in root.rglob('*.[ch]'):
-            for ex in excludes:
-                if ex in str(p.parent):
-                    #logger.debug(f"Skipping {p}")
-                    break
-            else:
-                paths.append(str(p))
-                #logger.debug(f"p={p}")
-                if i % 5 == 0:
-                    partial_path = ''.join(p.parts[-4:])
-                    status.update(
-                        f"{status_msg} [blue]({len(paths)})[/blue]: "
-                        f"[yellow].../{partial_path}[/yellow]"
-                    )
-
-            i += 1
+    status_msg = "Searching paths for files:"
+
+    # A file is excluded if an excluded path is contained in its parent
+    # directory path. Any directory matching an exclude therefore excludes its
+    # whole subtree, so matching directories are pruned rather than walked.
+    # Since every ancestor of a directory has already been checked, excludes
+    # without a path separator only need to be searched for in the directory
+    # name; the rest are searched for in the full directory path.
+    exclude_names = frozenset(excludes)
+    name_excludes = [ex for ex in excludes if os.sep not in ex]
+    path_excludes = [ex for ex in excludes if os.sep in ex]
+    name_re = compile_excludes(name_excludes)
+    path_re = compile_excludes(path_excludes)
+
+    def is_excluded(entry: os.DirEntry) -> bool:
+        return (entry.name in exclude_names
+                or (name_re is not None and name_re.search(entry.name))
+                or (path_re is not None and path_re.search(entry.path)))
+
+    if any(ex in root for ex in excludes):
+        return paths
+
+    # Progress is written straight to the terminal (throttled to ~10 updates
+    # per second) rather than through a rich status, which would parse markup
+    # and take the render lock on every update.
+    show_progress = sys.stderr.isatty()
+    last_update = 0.0
+
+    stack = [root]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError:
+            continue
+
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if not is_excluded(entry):
+                        stack.append(entry.path)
+                elif entry.name.endswith(source_suffixes):
+                    paths.append(entry.path)
+                    #logger.debug(f"p={entry.path}")
+                    if show_progress:
+                        now = time()
+                        if now - last_update > 0.1:
+                            last_update = now
+                            partial_path = os.sep.join(
+                                entry.path.rsplit(os.sep, 4)[-4:]).lstrip(os.sep)
+                            sys.stderr.write(
+                                f"\r{status_msg} ({len(paths)}): "
+                                f".../{partial_path}\x1b[K")
+                            sys.stderr.flush()
+
+    if show_progress and last_update:
+        # Clear the progress line.
+        sys.stderr.write("\r\x1b[K")
+        sys.stderr.flush()
 
     return paths
 
 
-def cflow(paths, **extraopts):
-    """Runs cflow command and returns results as a list of strings.
+def stream_cflow(cmd: List[str], stderr: List[str]) -> Iterator[str]:
+    """Yields lines of cflow output as they are produced. Lines of cflow's
+    stderr are appended to the stderr list once cflow exits.
+    """
+    err, rc = yield from shell_cmd_stream(cmd)
+    # Keep stderr before checking rc; on failure it usually explains why.
+    # err is None if cflow could not be run at all.
+    stderr.extend(err or [])
+    if rc != 0:
+        logger.error(f"cflow returned code {rc}")
+        sys.exit(1)
+
+
+def stream_cflow_shards(cmds: List[List[str]],
+                        stderr: List[str]) -> Iterator[str]:
+    """Runs one cflow process per command concurrently, yielding their output
+    in the order of cmds. Lines of stderr from each process are appended to
+    the stderr list as its output is reached.
+    """
+    # The first shard's output is streamed as it is produced, so it can be
+    # consumed while the others run; the rest are collected in the
+    # background until their turn comes.
+    run_cmd = partial(shell_cmd, timeout=None)
+    with ThreadPoolExecutor(max_workers=max(1, len(cmds) - 1)) as ex:
+        results = ex.map(run_cmd, cmds[1:])
+        yield from stream_cflow(cmds[0], stderr)
+
+        for stdout, err, rc in results:
+            stderr.extend(err or [])
+            if rc != 0:
+                logger.error(f"cflow returned code {rc}")
+                sys.exit(1)
+
+            yield from stdout
+
+
+def shard_paths(paths: List[str], nshards: int) -> List[List[str]]:
+    """Splits paths into nshards groups of roughly equal total file size.
+    Paths keep their original relative order within each group.
+    """
+    def size(path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    # Assign the largest files first, each to the currently smallest shard.
+    # Ties (e.g. empty files) go to the shard with the fewest files, so
+    # zero-size files are spread out rather than all landing in one shard.
+    heap = [(0, 0, k) for k in range(nshards)]
+    assigned = [[] for _ in range(nshards)]
+    for n, path in sorted(enumerate(paths), key=lambda p: size(p[1]),
+                          reverse=True):
+        total, count, k = heapq.heappop(heap)
+        assigned[k].append(n)
+        heapq.heappush(heap, (total + size(path), count + 1, k))
+
+    return [[paths[n] for n in sorted(shard)] for shard in assigned if shard]
+
+
+def check_cflow(debug: bool = False) -> None:
+    """Exits if cflow is not installed. The PATH is only searched on the first
+    call. With debug set, the cflow version is also logged.
     """
-    # Check if cflow is installed.
-    stdout, stderr, rc = shell_cmd('cflow --help')
-    if stdout is None:
+    global cflow_installed
+    if cflow_installed is None:
+        cflow_installed = shutil.which('cflow') is not None
+        if cflow_installed and debug:
+            stdout, stderr, rc = shell_cmd('cflow --version')
+            if stdout:
+                logger.debug(f"Using {stdout[0]}")
+
+    if not cflow_installed:
         logger.error("Error detecting cflow application. Is it installed?")
         sys.exit(1)
 
+
+def cflow(paths, use_cache: bool = True, debug: bool = False,
+          parallel: bool = False,
+          **extraopts) -> Tuple[Iterator[str], List[str]]:
+    """Runs cflow command and returns results as a tuple (stdout, stderr).
+    stdout is an iterator over the lines of output, streamed from cflow as it
+    runs. stderr is a list of lines, filled in once stdout has been consumed.
+    If use_cache is set, results of a previous identical run are reused when
+    none of the paths have changed. If parallel is set, the paths are split
+    into shards which are run through separate cflow processes concurrently.
+    """
+    check_cflow(debug)
+
     cmd = ['cflow']
 
     required_opts = {
@@ -85,17 +229,32 @@ def cflow(paths, **extraopts):
 
     logger.info(f"cli: '{' '.join(cmd)}'")
 
+    nshards = min(os.cpu_count() or 1, 8, len(paths)) if parallel else 1
+
     logger.debug(f"Appending {len(paths)} paths to cli command")
-    for path in paths:
-        cmd.append(path.strip())
+    stderr = []
+    if nshards > 1:
+        shards = shard_paths(paths, nshards)
+        nshards = len(shards)
+        logger.info(f"Running {nshards} cflow processes in parallel.")
+        stdout = stream_cflow_shards([cmd + shard for shard in shards], stderr)
+        # Sharded output differs from that of a single run; keep it apart in
+        # the cache.
+        cmd = cmd + [f"--shards={nshards}"] + paths
+    else:
+        cmd.extend(paths)
+        stdout = stream_cflow(cmd, stderr)
 
-    with console.status("[sea_green1]Running cflow...[/sea_green1]"):
-        stdout, stderr, rc = shell_cmd(cmd)
-        if rc != 0:
-            logger.error(f"cflow returned code {rc}")
-            sys.exit(1)
+    if not use_cache:
+        return stdout, stderr
 
-    return stdout, stderr
+    key = cache.cache_key(cmd, paths)
+    cached = cache.load(key)
+    if cached is not None:
+        logger.info("Using cached cflow output.")
+        return cached
+
+    return cache.store(key, stdout, stderr), stderr
 
 
 def get_params(**kwargs):
@@ -146,9 +305,9 @@ def cli(ctx, **kwargs):
                          f"Provide --rootpath option.")
             sys.exit(1)
         else:
-            # Read file and load the paths list.
+            # Read file and load the paths list, skipping blank lines.
             with open(params.usefile) as fp:
-                paths = fp.readlines()
+                paths = [path for path in (line.strip() for line in fp) if path]
                 logger.info(f"Read {len(paths)} paths from {params.usefile}")
     elif params.rootpath:
         paths = get_file_list(params.rootpath, params.excludepath,
@@ -186,6 +345,10 @@ def is_true(arg):
 @click.option('--show-signatures', is_flag=True, help="Shows function signatures.")
 @click.option('--pager', is_flag=True, help="Use pager for output.")
 @click.option('--stderr', is_flag=True, help="Print cflow stderr output.")
+@click.option('--no-cache', is_flag=True, help="Always run cflow, ignoring cached results.")
+@click.option('--parallel', is_flag=True,
+              help="Split files across parallel cflow processes (calls between "
+                   "files in different processes are not resolved).")
 @click.option('--debug', is_flag=True, help="Shortcut for --loglevel=debug")
 @click.option('--verbose', '-v', is_flag=True, help="Extra debug verbosity")
 @click.pass_context
@@ -218,18 +381,21 @@ def run(ctx, **kwargs):
             copts[opt] = kwargs[opt]
 
     paths = ctx.obj['paths']
-    stdout, stderr = cflow(paths, **copts)
+    debug = params.debug or ctx.obj['cli_params'].loglevel == 'debug'
+    stdout, stderr = cflow(paths, use_cache=not params.no_cache, debug=debug,
+                           parallel=params.parallel, **copts)
 
     if params.main:
         main_func = f"{params.main}()"
     else:
         main_func = None
 
-    if len(stdout) < 2:
-        logger.info("No results from cflow.")
-        return
+    status_msg = "[sea_green1]Running cflow...[/sea_green1]"
 
     if "raw" in params.format:
+        # Raw output is both printed and parsed, so collect it up front.
+        with console.status(status_msg):
+            stdout = list(stdout)
         lines = '\n'.join(stdout)
         if params.pager:
             with console.pager(styles=True):
@@ -237,12 +403,19 @@ def run(ctx, **kwargs):
         else:
             console.print(lines)
 
-    if params.stderr:
-        console.print("[sea_green1]cflow: stderr[/sea_green1]")
-        for line in stderr:
-            console.print(line)
-
-    cfp = CflowParser(stdout, main=main_func, verbose=params.verbose)
+    # stderr is only complete once the output has been parsed. Print it even
+    # if the parser exits (e.g. main not found), since it often explains why.
+    try:
+        with console.status(status_msg):
+            cfp = CflowParser(stdout, main=main_func, verbose=params.verbose)
+    finally:
+        if params.stderr:
+            console.print("[sea_green1]cflow: stderr[/sea_green1]")
+            for line in stderr:
+                console.print(line)
+
+    if cfp.nodetree is None:
+        return
 
     if "tree" in params.format:
         logger.info("Generating rich tree.")
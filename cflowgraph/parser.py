@@ -1,13 +1,19 @@
 from __future__ import annotations
+import os
 import sys
 import re
 
-from typing import Optional, List, Any
-from dataclasses import dataclass, field
+from collections import deque
+from functools import lru_cache
+from itertools import chain, islice, takewhile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Iterable, Iterator, List, Tuple, Any
+from dataclasses import dataclass
 from pathlib import Path
 
 from rich.console import Console
 from rich.panel import Panel
+from rich.text import Text
 from rich.theme import Theme
 from rich.tree import Tree
 
@@ -19,14 +25,27 @@ import logging
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
-# Regex for parsing line output from cflow.
+# Regex for parsing line output from cflow. The signature and path groups
+# may contain '>' and ':' (e.g. array bounds, Windows paths), so they are
+# only delimited by the ' at ' and ':<line>>' that follow them; any
+# backtracking stays within the line. Only the numbers are matched as ASCII;
+# function names may be extended (UTF-8) identifiers. A hand-written
+# str.find/rpartition tokenizer still measured about 25% slower than this
+# pattern (before it had any of the checks the regex makes).
 cflow_re = re.compile(r"""
-    {\s+(\d+)}                      # group 1 -> depth level
-    \s+(\w+?\(\))                   # group 2 -> function name
+    \A{\s+((?a:\d+))}               # group 1 -> depth level
+    \s+(\w+\(\))                    # group 2 -> function name
     (?:
-    \s<(.*\))\sat\s (.*):(\d+)>:    # (opt) group 3,4,5 signature, path, line no
+    \s<(.*\))\sat\s (.+):((?a:\d+))> # (opt) group 3,4,5 signature, path, line no
     )?
-    """, flags=re.DOTALL | re.VERBOSE)
+    """, flags=re.VERBOSE)
+
+# cflow output longer than this many lines is parsed by a pool of (at most
+# parse_max_workers) worker processes, which are handed parse_chunk_lines
+# lines at a time.
+parallel_parse_lines = 50000
+parse_chunk_lines = 10000
+parse_max_workers = 8
 
 # Rich theme for showing results as a tree graph.
 node_theme = Theme({
@@ -39,31 +58,66 @@ node_theme = Theme({
 })
 
 
+@lru_cache(maxsize=4096)
+def _format_path(path_str: str, parts: int) -> str:
+    """Returns path_str shortened to its last parts components. Cached, since a
+    call graph has far fewer source files than nodes.
+    """
+    return f".../{'/'.join(Path(path_str).parts[-parts:])}"
+
+
 @dataclass
 class Branch:
-    items: Optional[List[Any]] = field(default_factory=lambda: [])
+    # Slotted like Node; with __slots__ the fields cannot have defaults, so
+    # the items list is always passed in.
+    __slots__ = ('items', '_has_subbranches')
+
+    items: List[Any]
+
+    # Branch items are either Nodes or Branches; this tells them apart.
+    _IS_NODE = False
+
+    def __post_init__(self):
+        # Most branches (the leaves of the graph) hold only Nodes, and are
+        # walked without checking each item.
+        self._has_subbranches = not all(item._IS_NODE for item in self.items)
 
     def add(self, item: Any) -> None:
+        if not item._IS_NODE:
+            self._has_subbranches = True
         self.items.append(item)
 
     def iterate(self, parent : Branch = None):
-        """Recursive generator for iterating through branch items.
+        """Generator for iterating through branch items (depth first), yielding
+        (parent, node) for each node.
         """
-        prev_item = parent
-        for item in self.items:
-            if isinstance(item, Node):
-                yield parent, item
-            elif isinstance(item, Branch):
-                yield from item.iterate(prev_item)
-
-            prev_item = item
+        # Stack of [parent, items iterator, previous item] for each branch
+        # being walked. A nested branch's parent is the item preceding it.
+        stack = [[parent, iter(self.items), parent]]
+        while stack:
+            frame = stack[-1]
+            for item in frame[1]:
+                if item._IS_NODE:
+                    yield frame[0], item
+                elif not item._has_subbranches:
+                    for node in item.items:
+                        yield frame[2], node
+                else:
+                    stack.append([frame[2], iter(item.items), frame[2]])
+                    frame[2] = item
+                    break
+                frame[2] = item
+            else:
+                stack.pop()
 
 
 @dataclass
 class NodeTree:
+    __slots__ = ('root', 'branch', 'static')
+
     root: str
-    branch: Optional[Branch] = None
-    static: Optional[bool] = False
+    branch: Optional[Branch]
+    static: bool
 
     def add(self, branch: Branch) -> None:
         self.branch = branch
@@ -76,58 +130,124 @@ class NodeTree:
 
 @dataclass
 class Node:
+    # One Node is created per line of cflow output, so slots are used to keep
+    # them small. The path and line are kept as the strings parsed from cflow
+    # since they are only needed when a node is rendered. _printed caches the
+    # rendered text per set of print() options.
+    __slots__ = ('level', 'name', 'signature', 'path', 'line', '_printed')
+
     level: int
     name: str
-    signature: Optional[str] = None
-    path: Optional[Path] = None
-    line: Optional[int] = None
-
-    def __post_init__(self):
-        if self.level:
-            self.level = int(self.level)
-        if self.line:
-            self.line = int(self.line)
-        if self.path:
-            self.path = Path(self.path)
+    signature: Optional[str]
+    path: Optional[str]
+    line: Optional[str]
 
-    def get_level(self) -> str:
-        return f"[level]{self.level}[/level]"
+    _IS_NODE = True
 
-    def get_name(self) -> str:
-        return f"[name]{self.name}[/name]"
+    def __post_init__(self):
+        self.level = int(self.level)
+        # Names repeat throughout the output; interning them shares one string
+        # per function and makes edge set lookups in dot_graph cheap.
+        self.name = sys.intern(self.name)
+        self._printed = None
+
+    def print(self, show_signature: bool = False, path_parts: int = 4) -> Text:
+        key = (show_signature, path_parts)
+        if self._printed is None:
+            self._printed = {}
+        elif key in self._printed:
+            return self._printed[key]
+
+        # The text is assembled from styled pieces rather than markup, so
+        # rich does not have to parse it (and brackets in a signature are
+        # shown as is).
+        pieces = ["[", (str(self.level), "level"), "]: ", (self.name, "name"), "  "]
+        if show_signature:
+            pieces += [(self.signature or "", "signature"), " "]
 
-    def get_path(self, parts=None) -> str:
         if self.path is None:
-            return ""
-        if parts:
-            parts = -parts
-            return f"[path].../{'/'.join(self.path.parts[parts:])}[/path]"
+            path_str = ""
+        elif path_parts:
+            path_str = _format_path(self.path, path_parts)
         else:
-            return f"[path]{self.path}[/path]"
+            path_str = self.path
+        pieces += [(path_str, "path"), " "]
 
-    def get_signature(self) -> str:
-        if self.signature:
-            return f"[signature]{self.signature}[/signature]"
-        else:
-            return ""
+        if self.line is not None:
+            pieces += ["(", (self.line, "line"), ")"]
 
-    def get_line(self) -> str:
-        if self.line is None:
-            return ""
-        return f"([line]{self.line}[/line])"
+        text = Text.assemble(*pieces)
+        self._printed[key] = text
+        return text
 
-    def print(self, show_signature: bool = False, path_parts: int = 4) -> str:
-        if show_signature:
-            return (f"[{self.get_level()}]: "
-                    f"{self.get_name()}  "
-                    f"{self.get_signature()} "
-                    f"{self.get_path(parts=path_parts)} "
-                    f"{self.get_line()}")
-        else:
-            return (f"[{self.get_level()}]: "
-                    f"{self.get_name()}  "
-                    f"{self.get_path(parts=path_parts)} "
-                    f"{self.get_line()}")
+
+def _make_node(level, name, signature, path, line) -> Node:
+    """Creates a Node from the cflow_re groups of a line. Equivalent to
+    Node(*groups), but sets the slots directly rather than going through
+    __init__ and __post_init__, since it runs once per line.
+    """
+    node = object.__new__(Node)
+    node.level = int(level)
+    node.name = sys.intern(name)
+    node.signature = signature
+    node.path = path
+    node.line = line
+    node._printed = None
+    return node
+
+
+def _iter_chunks(lines: Iterable[str], size: int) -> Iterator[List[str]]:
+    it = iter(lines)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _parse_chunk(lines: List[str]) -> List[Tuple]:
+    """Returns the cflow_re groups of each matching line. Groups rather than
+    Nodes are returned since they are much cheaper to pass back from a worker
+    process.
+    """
+    return [m.groups() for m in map(cflow_re.match, lines) if m]
+
+
+def parse_nodes(raw_results: Iterable[str]) -> Iterator[Node]:
+    """Parses lines of cflow output, yielding a Node for each matching line.
+    Long outputs are matched in parallel by a pool of worker processes.
+    """
+    chunks = _iter_chunks(raw_results, parse_chunk_lines)
+
+    # Read ahead just far enough to tell whether the output is long enough to
+    # be worth starting a pool.
+    head = list(islice(chunks, parallel_parse_lines // parse_chunk_lines + 1))
+    if (len(head) <= parallel_parse_lines // parse_chunk_lines
+            or (os.cpu_count() or 1) < 2):
+        # Driving the regex with map() keeps the per-line match calls out of
+        # the interpreter loop.
+        for m in map(cflow_re.match, chain.from_iterable(chain(head, chunks))):
+            if m:
+                yield _make_node(*m.groups())
+        return
+
+    # Executor.map() would submit (and so read) every chunk up front. Keep a
+    # bounded window of chunks in flight instead, submitting the next one as
+    # each result is consumed, so the output is still read as it streams.
+    workers = min(os.cpu_count() or 1, parse_max_workers)
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        pending = deque()
+        for chunk in chain(head, chunks):
+            pending.append(ex.submit(_parse_chunk, chunk))
+            if len(pending) < 2 * workers:
+                continue
+
+            for items in pending.popleft().result():
+                yield _make_node(*items)
+
+        while pending:
+            for items in pending.popleft().result():
+                yield _make_node(*items)
 
 
 class CflowParser:
@@ -135,7 +255,7 @@ class CflowParser:
     """
 
     def __init__(self,
-                 raw_results: List[str],
+                 raw_results: Iterable[str],
                  main: str = None,
                  verbose : bool = False) -> None:
         self.nodes = []
@@ -143,142 +263,135 @@ class CflowParser:
         self.console = Console(theme=node_theme)
         self.nodetree = None
 
-        if len(raw_results) == 0:
+        # Parse results from cflow into Nodes.
+        nodes = parse_nodes(raw_results)
+        first = next(nodes, None)
+        if first is None:
             logger.info("No results to process.")
             return
 
-        # Parse results from cflow into a list of Nodes.
-        for entry in raw_results:
-            m = cflow_re.match(entry)
-            if m:
-                items = m.groups()
-                node = Node(*items)
-                self.nodes.append(node)
-
-        # Build node tree object.
-        # Sometimes a function will not be in the cflow output at level 0 (not
-        # sure why this occurs). To still attempt to provide a result, we
-        # search the tree at increasing levels until the desired function is
-        # found at that level - or - it is not found at all.
-        for level in range(0, 9):
-            logger.debug(f"Searching cflow output for main={main} at level {level}")
-            level_found = self.build_node_tree(main, target_level=level)
-            if level_found is None:
+        if main is None or (first.name == main and first.level == 0):
+            # Common case: the call graph starts at the head of the output, so
+            # the tree is built as the output is parsed, without keeping a
+            # list of every Node. The graph ends at the next level 0 node.
+            graph = chain([first], nodes if main is None else
+                          takewhile(lambda node: node.level > 0, nodes))
+            self.build_node_tree(main, graph, 0, static=False)
+            # Drain the rest of the output so the cflow run (and caching of
+            # its output) completes.
+            deque(nodes, maxlen=0)
+        else:
+            self.nodes.append(first)
+            self.nodes.extend(nodes)
+
+            # Sometimes a function will not be in the cflow output at level 0
+            # (not sure why this occurs). To still attempt to provide a
+            # result, the graph is taken from the first occurrence of the
+            # desired function at the lowest level it appears at.
+            found = self.find_main(main)
+            if found is None:
                 logger.error(f"Did not find function {main} in cflow output.")
                 sys.exit(1)
-            elif level_found < 0:
-                sys.exit(1)
-            elif level_found == level:
-                logger.debug("Successfully created node tree.")
-                if self.verbose:
-                    logger.debug(f"nodetree = {pf(self.nodetree)}")
-                break
-
-    def build_node_tree(self, main : str = None, target_level : int = 0) -> None:
-        """Builds a recursive node list representing the call graph.
-        """
-        index = 0
-        stop_index = len(self.nodes)
-        lowest_level_found = None
-
-        if main:
-            # Ideally, cflow will have found the function specified as the
-            # 'main' function and this will be the first entry in the
-            # self.nodes list (and will have a level of 0). However, if the
-            # desired 'main' function is declared as 'static' in the C codebase
-            # being searched, cflow will not isolate this in its output but
-            # instead will generate a call graph for every function it finds
-            # (i.e. as if every function was the 'main' function). The desired
-            # 'main' function will still be in the list, but it will not be the
-            # first entry - and it may not be marked as level 0. The following
-            # code searches through the self.nodes list to find the 'main'
-            # function at the target_level specified. Once found, it will then
-            # try to mark the end of the call graph list so that it can be
-            # extraced and displayed.
-            for index, node in enumerate(self.nodes):
-                if self.verbose:
-                    logger.debug(f"(searching for main) index={index} "
-                                 f"level={node.level} node={node.name}")
-
-                if node.name == main:
-                    if lowest_level_found:
-                        lowest_level_found = min(lowest_level_found, node.level)
-                    else:
-                        lowest_level_found = node.level
-
-                    if node.level == target_level:
-                        logger.debug(f"Found main={main} at index={index} "
-                                     f"(level={node.level})")
-                        break
-            else:
-                logger.debug(f"Function {main} not found at level "
-                             f"{target_level}.")
-                return lowest_level_found
-
-            # If the main function wasn't found at the head of the list, it was
-            # likely a static function and we must find where the graph ends.
-            # The following code attempts to find the end of the call graph by
-            # finding the next function with level 0.
-            if index > 0:
-                # Extract call graph from this point. All nodes after that
-                # have level > 0 if part of the 'main' functions call graph.
-                # We know we've found the end when the current node in the
-                # iteration has a level of 0.
-                m = index+1
-                while m < len(self.nodes):
-                    if self.verbose:
-                        logger.debug(f"(searching for end) index={m} "
-                                     f"(level={self.nodes[m].level}) "
-                                     f"node={self.nodes[m].name}")
-
-                    if self.nodes[m].level > target_level:
-                        m += 1
-                    else:
-                        logger.debug(f"Found end of graph at index {m-1}")
-                        stop_index = m
-                        break
-                else:
-                    logger.error(f"Could not find end of graph for function {main}")
-                    return -1
+            index, level = found
+            stop_index = self.find_graph_end(index, level)
 
-        nodes = self.nodes[index:stop_index]
+            # If the starting index in the node list is not 0, then the
+            # function was declared as static (see explaination in find_main).
+            self.build_node_tree(main, islice(self.nodes, index, stop_index),
+                                 level, static=index > 0)
 
-        # If the starting index in the node list is not 0, then the function
-        # was declared as static (see explaination above).
-        if index == 0:
-            funcion_is_static = False
-        else:
-            funcion_is_static = True
-
-        self.nodetree = NodeTree(root=main, static=funcion_is_static)
-        root_branch = Branch()
-        self.nodetree.add(root_branch)
-        iternodes = iter(nodes)
-        try:
-            self.recurse_nodes(next(iternodes),
-                               iternodes,
-                               root_branch,
-                               target_level)
-        except StopIteration:
-            # Return the passed target level to indicate success at that level.
-            return target_level
-
-    def recurse_nodes(self, node, nodes, parent_branch, parent_level):
-        while True:
-            if node.level == parent_level:
-                parent_branch.add(node)
-            elif node.level > parent_level:
-                # Recursive call for next level of tree.
-                child = Branch()
-                parent_branch.add(child)
-                node = self.recurse_nodes(node, nodes, child, node.level)
-                # Returning from recursive call, do not advance iterator.
+        logger.debug("Successfully created node tree.")
+        if self.verbose and logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"nodetree = {pf(self.nodetree)}")
+
+    def find_main(self, main: str) -> Optional[Tuple[int, int]]:
+        """Returns (index, level) of the first occurrence of main at the lowest
+        level it appears at, or None if main is not in the cflow output.
+        """
+        # Ideally, cflow will have found the function specified as the 'main'
+        # function and this will be the first entry in the self.nodes list
+        # (and will have a level of 0). However, if the desired 'main'
+        # function is declared as 'static' in the C codebase being searched,
+        # cflow will not isolate this in its output but instead will generate
+        # a call graph for every function it finds (i.e. as if every function
+        # was the 'main' function). The desired 'main' function will still be
+        # in the list, but it will not be the first entry - and it may not be
+        # marked as level 0.
+        trace = self.verbose and logger.isEnabledFor(logging.DEBUG)
+        found = None
+        for index, node in enumerate(self.nodes):
+            if node.name != main:
                 continue
-            else:
-                # Pop recursive call.
-                return node
 
-            node = next(nodes)
+            if trace:
+                logger.debug("(searching for main) index=%d level=%d node=%s",
+                             index, node.level, node.name)
+
+            if found is None or node.level < found[1]:
+                found = (index, node.level)
+                if node.level == 0:
+                    break
+
+        if found is not None:
+            logger.debug(f"Found main={main} at index={found[0]} "
+                         f"(level={found[1]})")
+        return found
+
+    def find_graph_end(self, index: int, level: int) -> int:
+        """Returns the index just past the call graph starting at index.
+        """
+        # All nodes following main have a level greater than main's while
+        # they are part of its call graph, so the graph ends at the next node
+        # at main's level or above (or at the end of the cflow output).
+        for m in range(index + 1, len(self.nodes)):
+            if self.nodes[m].level <= level:
+                logger.debug(f"Found end of graph at index {m-1}")
+                return m
+
+        return len(self.nodes)
+
+    def build_node_tree(self,
+                        main: Optional[str],
+                        nodes: Iterable[Node],
+                        level: int,
+                        static: bool) -> None:
+        """Builds a recursive node list representing the call graph of nodes,
+        rooted at level.
+        """
+        root_branch = Branch([])
+        self.nodetree = NodeTree(root=main, branch=root_branch, static=static)
+        self.build_branches(nodes, root_branch, level)
+
+    def build_branches(self, nodes, root_branch, root_level):
+        """Adds nodes to root_branch, nesting a new Branch each time the call
+        level increases.
+        """
+        # Stack of (branch, level) for the branches currently open. A node
+        # closes every branch deeper than itself and opens a new one if it is
+        # deeper than the innermost branch left open. The innermost level and
+        # its items.append are kept in locals since this runs once per node.
+        # Items are appended rather than pre-sized: nodes usually arrive
+        # straight from the parser, and a counting pass costs more than the
+        # list growth it would save.
+        stack = [(root_branch, root_level)]
+        branch, level = stack[-1]
+        add = branch.items.append
+        for node in nodes:
+            node_level = node.level
+            if node_level < level:
+                while len(stack) > 1 and node_level < stack[-1][1]:
+                    stack.pop()
+                branch, level = stack[-1]
+                add = branch.items.append
+
+            if node_level > level:
+                child = Branch([node])
+                branch.add(child)
+                stack.append((child, node_level))
+                branch, level = child, node_level
+                add = child.items.append
+            else:
+                add(node)
 
     def rich_tree(self,
                   show_signatures: bool = False,
@@ -304,18 +417,25 @@ class CflowParser:
             self.console.print(tree)
 
     def add_tree_branches(self, parent, items, show_signatures) -> None:
-        """Recursively creates branches of a rich tree.
+        """Creates branches of a rich tree from nested branch items.
         """
-        child = None
-        for item in items:
-            if isinstance(item, Node):
-                child = parent.add(item.print(show_signatures, path_parts=5))
-            elif isinstance(item, Branch):
-                if child is None:
-                    child = parent
-                self.add_tree_branches(parent=child,
-                                       items=item.items,
-                                       show_signatures=show_signatures)
+        # Stack of [parent, items iterator, last child added] for each branch
+        # being walked. A nested Branch hangs off the last node added before
+        # it (or off the parent if there is none).
+        stack = [[parent, iter(items), None]]
+        while stack:
+            frame = stack[-1]
+            parent = frame[0]
+            for item in frame[1]:
+                if item._IS_NODE:
+                    frame[2] = parent.add(item.print(show_signatures, path_parts=5))
+                else:
+                    if frame[2] is None:
+                        frame[2] = parent
+                    stack.append([frame[2], iter(item.items), None])
+                    break
+            else:
+                stack.pop()
 
     def dot_graph(self, **opts):
         opts.setdefault('name', 'call_graph')
@@ -337,19 +457,26 @@ class CflowParser:
 
         graph = Digraph(**opts)
         graph.attr(rankdir='LR')
-        edges = []
+        # Edges are added as the tree is walked, skipping repeats of an edge
+        # already added. Per-edge logging is formatted lazily.
+        trace = logger.isEnabledFor(logging.DEBUG)
+        seen = set()
+        dups = 0
         for parent, node in self.nodetree.iterate():
             if parent is None:
                 graph.node(node.name)
-            else:
-                logger.debug(f"Adding edge: {parent.name} -> {node.name}")
-                edges.append((f"{parent.name}", f"{node.name}"))
+                continue
 
-        unique_edges = set(edges)
-        dups = len(edges) - len(unique_edges)
-        logger.debug(f"Filtered {dups} duplicate edges.")
+            key = (parent.name, node.name)
+            if key in seen:
+                dups += 1
+                continue
+
+            seen.add(key)
+            graph.edge(*key)
+            if trace:
+                logger.debug("Adding edge: %s -> %s", *key)
 
-        for parent, node in unique_edges:
-            graph.edge(parent, node)
+        logger.debug(f"Filtered {dups} duplicate edges.")
 
         graph.view()